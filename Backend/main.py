@@ -1,55 +1,110 @@
 # main.py
 import ast
 import logging
+import os
+from functools import lru_cache
+from itertools import islice
 from fastapi import FastAPI, Query
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"]
 )
+# flowcharts for big functions run to tens of KB of repetitive text; small replies stay uncompressed
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=6)
 
 class CodeRequest(BaseModel):
+    # strict: no coercion attempts on the (possibly large) code field; forbid: reject unknown keys
+    model_config = ConfigDict(strict=True, frozen=True, extra="forbid")
+
     code: str
 
+# single-pass replacement table for escape_label
+_LABEL_TRANS = str.maketrans({"\n": " ", "\r": " ", '"': "'", "|": "/"})
+
 def escape_label(s: str) -> str:
     """Make label safe for Mermaid: remove newlines, double quotes, pipes."""
     if s is None:
         s = ""
-    s = str(s)
-    s = s.replace("\n", " ").replace('"', "'").replace("|", "/").strip()
-    return s
+    return str(s).translate(_LABEL_TRANS).strip()
+
+# mermaid node brackets per shape (circle uses double parens) and edge tokens
+_RECT = ("[", "]")
+_SHAPES = {"circle": ("((", "))"), "diamond": ("{", "}"), "rect": _RECT}
+_EDGE = " --> "
+_EDGE_LABEL_OPEN = " -->|"
+_EDGE_LABEL_CLOSE = "| "
+# lines per StreamingResponse chunk for /analyze/flowchart
+_STREAM_CHUNK_LINES = 2000
+
+# ast.unparse is 3.9+; resolve once at import instead of probing per label
+_HAS_UNPARSE = hasattr(ast, "unparse")
+_unparse = ast.unparse if _HAS_UNPARSE else (lambda n: type(n).__name__)
 
 class FlowBuilder:
-    def __init__(self):
-        self.nodes = []        # list of (id, label, shape)
-        self.edges = []        # list of (src, dst, label_or_none)
-        self._id = 0
+    __slots__ = ("labels", "shapes", "edges", "_lines", "_dispatch")
 
-    def new_id(self):
-        nid = f"N{self._id}"
-        self._id += 1
-        return nid
+    def __init__(self, source: str = None):
+        # nodes as parallel lists indexed by node id (an int; rendered as N<id>)
+        self.labels = []
+        self.shapes = []
+        self.edges = []        # list of (src, dst, label_or_none)
+        # original code, split once so labels can be sliced out by node offsets
+        # (ast offsets are utf-8 byte columns, hence bytes)
+        self._lines = source.encode("utf-8").splitlines(keepends=True) if source is not None else None
+        # statement type -> handler; one dict lookup instead of an isinstance chain
+        self._dispatch = {
+            ast.Return: self._stmt_return,
+            ast.Assign: self._stmt_assign,
+            ast.AugAssign: self._stmt_augassign,
+            ast.Expr: self._stmt_expr,
+            ast.If: self._stmt_if,
+            ast.For: self._stmt_for,
+            ast.While: self._stmt_while,
+        }
+
+    def source_text(self, node) -> str:
+        """Source text of node, sliced from the original code instead of re-unparsing it.
+
+        Multi-line nodes, and builders created without source, are unparsed instead,
+        so comments and indentation don't leak into labels.
+        """
+        if self._lines is None or node.lineno != node.end_lineno:
+            return _unparse(node)
+        text = self._lines[node.lineno - 1][node.col_offset:node.end_col_offset]
+        return text.decode("utf-8") or type(node).__name__
 
     def add_node(self, label: str, shape: str = "rect"):
         label = escape_label(label)
-        nid = self.new_id()
-        self.nodes.append((nid, label, shape))
-        logger.debug(f"add_node: {nid} ({shape}) label='{label}'")
+        nid = len(self.labels)
+        self.labels.append(label)
+        self.shapes.append(shape)
+        return nid
+
+    def add_sentinel(self, label: str):
+        """Add a fixed marker node ("Continue", "After Loop", "pass"); constant labels skip escaping.
+
+        Sentinels are not shared between statements: each one is a distinct point in the flow.
+        """
+        nid = len(self.labels)
+        self.labels.append(label)
+        self.shapes.append("rect")
         return nid
 
-    def add_edge(self, src: str, dst: str, label: str = None):
+    def add_edge(self, src: int, dst: int, label: str = None):
         if src is None or dst is None:
-            logger.debug(f"SKIP add_edge due to None src/dst: {src} -> {dst} label={label}")
             return
         # Use -->|label| style when label present
         self.edges.append((src, dst, label))
-        logger.debug(f"add_edge: {src} -- {label or ''} --> {dst}")
 
     def stmt_sequence(self, stmts):
         """
@@ -61,9 +116,12 @@ class FlowBuilder:
         entry = None
         last_exit = None
         terminal = False
+        # hoisted bound methods: saves attribute lookups per statement
+        process_stmt = self.process_stmt
+        add_edge = self.add_edge
 
-        for i, stmt in enumerate(stmts):
-            s_entry, s_exit, s_term = self.process_stmt(stmt)
+        for stmt in stmts:
+            s_entry, s_exit, s_term = process_stmt(stmt)
             if s_entry is None:
                 # nothing generated for this statement
                 continue
@@ -71,7 +129,7 @@ class FlowBuilder:
                 entry = s_entry
             if last_exit is not None:
                 # connect previous exit -> this entry
-                self.add_edge(last_exit, s_entry)
+                add_edge(last_exit, s_entry)
             last_exit = s_exit
             # if this statement is terminal and there are subsequent statements,
             # they are unreachable via normal control flow
@@ -86,248 +144,290 @@ class FlowBuilder:
     def process_stmt(self, stmt):
         """
         Process single statement. Return (entry, exit, terminal_flag).
-        entry and exit are node ids (strings) or None if nothing created.
+        entry and exit are node ids (ints) or None if nothing created.
         """
-        if isinstance(stmt, ast.Return):
-            try:
-                code = ast.unparse(stmt.value) if hasattr(ast, "unparse") and stmt.value is not None else "return"
-            except Exception:
-                code = "return"
-            node = self.add_node(f"return {code}", "rect")
-            return node, node, True
+        handler = self._dispatch.get(type(stmt), self._stmt_fallback)
+        return handler(stmt)
 
-        if isinstance(stmt, ast.Assign):
-            try:
-                code = ast.unparse(stmt)
-            except Exception:
-                targets = ", ".join([t.id if isinstance(t, ast.Name) else "?" for t in stmt.targets])
-                code = f"{targets} = ?"
-            node = self.add_node(code, "rect")
-            return node, node, False
+    def _stmt_return(self, stmt):
+        try:
+            code = self.source_text(stmt.value) if stmt.value is not None else "return"
+        except Exception:
+            code = "return"
+        node = self.add_node(f"return {code}", "rect")
+        return node, node, True
 
-        if isinstance(stmt, ast.AugAssign):
-            try:
-                code = ast.unparse(stmt)
-            except Exception:
-                code = "augassign"
-            node = self.add_node(code, "rect")
-            return node, node, False
+    def _stmt_assign(self, stmt):
+        try:
+            code = self.source_text(stmt)
+        except Exception:
+            targets = ", ".join([t.id if isinstance(t, ast.Name) else "?" for t in stmt.targets])
+            code = f"{targets} = ?"
+        node = self.add_node(code, "rect")
+        return node, node, False
 
-        if isinstance(stmt, ast.Expr):
-            # expression, e.g., call like print(...)
-            try:
-                code = ast.unparse(stmt.value) if hasattr(ast, "unparse") else ast.dump(stmt)
-            except Exception:
-                code = ast.dump(stmt)
-            node = self.add_node(code, "rect")
-            return node, node, False
+    def _stmt_augassign(self, stmt):
+        try:
+            code = self.source_text(stmt)
+        except Exception:
+            code = "augassign"
+        node = self.add_node(code, "rect")
+        return node, node, False
 
-        if isinstance(stmt, ast.If):
+    def _stmt_expr(self, stmt):
+        # expression, e.g., call like print(...)
+        try:
+            code = self.source_text(stmt.value)
+        except Exception:
+            code = ast.dump(stmt)
+        node = self.add_node(code, "rect")
+        return node, node, False
+
+    def _stmt_if(self, stmt):
+        # an elif chain is walked with a loop instead of one process_stmt recursion per elif,
+        # so long chains don't hit the recursion limit. Nodes/edges come out in the same order:
+        # conditions and then-branches top-down, then else/merge wiring bottom-up.
+        chain = []
+        while True:
             # condition node (diamond)
             try:
-                cond_text = ast.unparse(stmt.test) if hasattr(ast, "unparse") else "cond"
+                cond_text = self.source_text(stmt.test)
             except Exception:
                 cond_text = "cond"
             cond_node = self.add_node(cond_text, "diamond")
 
             # then branch (True)
             then_entry, then_exit, then_term = self.stmt_sequence(stmt.body)
-            if then_entry:
+            if then_entry is not None:
                 self.add_edge(cond_node, then_entry, "True")
             else:
                 # empty then (rare) -> connect to a dummy pass node
-                pass_node = self.add_node("pass", "rect")
+                pass_node = self.add_sentinel("pass")
                 self.add_edge(cond_node, pass_node, "True")
                 then_exit = pass_node
                 then_term = False
+            chain.append((stmt, cond_node, then_exit, then_term))
+
+            # if orelse is a single If, treat as elif chain and continue with that If
+            if len(stmt.orelse) == 1 and isinstance(stmt.orelse[0], ast.If):
+                stmt = stmt.orelse[0]
+            else:
+                break
+
+        # innermost else: a plain sequence, or nothing (False falls through to the merge node)
+        if stmt.orelse:
+            e_entry, e_exit, e_term = self.stmt_sequence(stmt.orelse)
+        else:
+            e_entry, e_exit, e_term = None, None, False
 
-            # else branch: could be elif (If in orelse) or a sequence
-            else_entry = None
+        # unwind: each level's else is the (entry, exit, terminal) of the level below it
+        for stmt, cond_node, then_exit, then_term in reversed(chain):
             else_exit = None
             else_term = False
-            if stmt.orelse:
-                # if orelse is a single If, treat as elif chain by processing that If
-                if len(stmt.orelse) == 1 and isinstance(stmt.orelse[0], ast.If):
-                    o_stmt = stmt.orelse[0]
-                    # process the elif If as a child; we want entry/exit/terminal
-                    e_entry, e_exit, e_term = self.process_stmt(o_stmt)
-                    if e_entry:
-                        self.add_edge(cond_node, e_entry, "False")
-                        else_entry = e_entry
-                        else_exit = e_exit
-                        else_term = e_term
-                else:
-                    e_entry, e_exit, e_term = self.stmt_sequence(stmt.orelse)
-                    if e_entry:
-                        self.add_edge(cond_node, e_entry, "False")
-                        else_entry = e_entry
-                        else_exit = e_exit
-                        else_term = e_term
-            else:
-                # no else: False should fall through to "continue" (we'll create merge)
-                # we'll mark else_exit None and else_term False
-                else_entry = None
-                else_exit = None
-                else_term = False
-
-            # Determine if all branches are terminal
-            if then_term and (else_term or not stmt.orelse):
-                # if both branches terminate (or no else and then_term True?), then this If is terminal
-                # careful: if no else and then_term True, the False path continues (i.e. not terminal).
-                # so only when there's an else and both are terminal treat terminal True.
-                all_terminal = False
-                if stmt.orelse:
-                    all_terminal = then_term and else_term
-                else:
-                    all_terminal = False
-            else:
-                all_terminal = False
+            if e_entry is not None:
+                self.add_edge(cond_node, e_entry, "False")
+                else_exit = e_exit
+                else_term = e_term
 
             # if at least one branch can continue, create a merge continuation node
             if (not then_term) or (stmt.orelse and not else_term):
-                merge_node = self.add_node("Continue", "rect")
+                merge_node = self.add_sentinel("Continue")
                 # connect then exit to merge if then branch didn't terminate
-                if then_exit and not then_term:
+                if then_exit is not None and not then_term:
                     self.add_edge(then_exit, merge_node)
                 # connect else exit to merge if exists and not terminal
-                if else_exit and not else_term:
+                if else_exit is not None and not else_term:
                     self.add_edge(else_exit, merge_node)
                 # if there's an else absent (no else), connect cond_node False to merge_node
                 if not stmt.orelse:
                     self.add_edge(cond_node, merge_node, "False")
-                return cond_node, merge_node, False
+                e_entry, e_exit, e_term = cond_node, merge_node, False
             else:
                 # both branches terminal (returns), If is terminal (no continuation)
-                return cond_node, None, True
+                e_entry, e_exit, e_term = cond_node, None, True
 
-        if isinstance(stmt, ast.For):
-            # for loop as diamond-like entry
-            try:
-                header = ast.unparse(stmt.target) + " in " + (ast.unparse(stmt.iter) if hasattr(ast, "unparse") else "iter")
-            except Exception:
-                header = "for"
-            loop_node = self.add_node(header, "diamond")
-            # body
-            body_entry, body_exit, body_term = self.stmt_sequence(stmt.body)
-            if body_entry:
-                self.add_edge(loop_node, body_entry, "True")
-            else:
-                # empty body
-                pass_node = self.add_node("pass", "rect")
-                self.add_edge(loop_node, pass_node, "True")
-                body_exit = pass_node
-                body_term = False
+        return e_entry, e_exit, e_term
 
-            # back edge from body_exit to loop_node if body exists and doesn't terminal on all paths
-            if body_exit and not body_term:
-                self.add_edge(body_exit, loop_node, "Next Iteration")
+    def _stmt_for(self, stmt):
+        # for loop as diamond-like entry
+        try:
+            header = self.source_text(stmt.target) + " in " + self.source_text(stmt.iter)
+        except Exception:
+            header = "for"
+        loop_node = self.add_node(header, "diamond")
+        # body
+        body_entry, body_exit, body_term = self.stmt_sequence(stmt.body)
+        if body_entry is not None:
+            self.add_edge(loop_node, body_entry, "True")
+        else:
+            # empty body
+            pass_node = self.add_sentinel("pass")
+            self.add_edge(loop_node, pass_node, "True")
+            body_exit = pass_node
+            body_term = False
 
-            after_node = self.add_node("After Loop", "rect")
-            self.add_edge(loop_node, after_node, "False")
+        # back edge from body_exit to loop_node if body exists and doesn't terminal on all paths
+        if body_exit is not None and not body_term:
+            self.add_edge(body_exit, loop_node, "Next Iteration")
 
-            return loop_node, after_node, False
+        after_node = self.add_sentinel("After Loop")
+        self.add_edge(loop_node, after_node, "False")
 
-        if isinstance(stmt, ast.While):
-            try:
-                cond_text = ast.unparse(stmt.test) if hasattr(ast, "unparse") else "while"
-            except Exception:
-                cond_text = "while"
-            loop_node = self.add_node(cond_text, "diamond")
-            body_entry, body_exit, body_term = self.stmt_sequence(stmt.body)
-            if body_entry:
-                self.add_edge(loop_node, body_entry, "True")
-            else:
-                pass_node = self.add_node("pass", "rect")
-                self.add_edge(loop_node, pass_node, "True")
-                body_exit = pass_node
-                body_term = False
+        return loop_node, after_node, False
+
+    def _stmt_while(self, stmt):
+        try:
+            cond_text = self.source_text(stmt.test)
+        except Exception:
+            cond_text = "while"
+        loop_node = self.add_node(cond_text, "diamond")
+        body_entry, body_exit, body_term = self.stmt_sequence(stmt.body)
+        if body_entry is not None:
+            self.add_edge(loop_node, body_entry, "True")
+        else:
+            pass_node = self.add_sentinel("pass")
+            self.add_edge(loop_node, pass_node, "True")
+            body_exit = pass_node
+            body_term = False
 
-            if body_exit and not body_term:
-                self.add_edge(body_exit, loop_node, "Repeat")
+        if body_exit is not None and not body_term:
+            self.add_edge(body_exit, loop_node, "Repeat")
 
-            after_node = self.add_node("After Loop", "rect")
-            self.add_edge(loop_node, after_node, "False")
-            return loop_node, after_node, False
+        after_node = self.add_sentinel("After Loop")
+        self.add_edge(loop_node, after_node, "False")
+        return loop_node, after_node, False
 
-        # fallback: create a generic node for unknown statement type
+    def _stmt_fallback(self, stmt):
+        # create a generic node for unknown statement type
         try:
-            code = ast.unparse(stmt) if hasattr(ast, "unparse") else type(stmt).__name__
+            code = self.source_text(stmt)
         except Exception:
             code = type(stmt).__name__
         node = self.add_node(code, "rect")
         return node, node, False
 
-    def build_for_function(self, func_node: ast.FunctionDef):
-        """Build flow for a single function AST node."""
+    def build_graph(self, func_node: ast.FunctionDef):
+        """Fill nodes/edges for a single function AST node."""
         # reset counters for a fresh graph per function
-        self.nodes = []
+        self.labels = []
+        self.shapes = []
         self.edges = []
-        self._id = 0
 
         # create function start node (circle)
         start_node = self.add_node(f"Function: {func_node.name}()", "circle")
-        entry, exit_node, terminal = self.stmt_sequence(func_node.body)
-        if entry:
-            self.add_edge(start_node, entry)
-        else:
-            # empty function: connect start -> end (nothing)
-            pass
-
-        # generate mermaid text
-        lines = ["flowchart TD"]
-        for nid, label, shape in self.nodes:
-            quoted = f'"{label}"'
-            if shape == "circle":
-                # circle uses double parens
-                lines.append(f'{nid}(({quoted}))')
-            elif shape == "diamond":
-                lines.append(f'{nid}{{{quoted}}}')
-            else:
-                lines.append(f'{nid}[{quoted}]')
-        # edges
+        entry, _, _ = self.stmt_sequence(func_node.body)
+        self.add_edge(start_node, entry)
+        logger.info("Built flowchart for %s(): %d nodes, %d edges", func_node.name, len(self.labels), len(self.edges))
+
+    def build_for_function(self, func_node: ast.FunctionDef):
+        """Build flow for a single function AST node."""
+        self.build_graph(func_node)
+        mermaid = "\n".join(self.iter_mermaid_lines())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Generated Mermaid:\n%s", mermaid)
+        return mermaid
+
+    def iter_mermaid_lines(self):
+        """Yield the graph from build_graph as Mermaid lines (no newlines); the only renderer."""
+        yield "flowchart TD"
+        # format every node id once; edges reference each id about twice
+        ids = [f"N{nid}" for nid in range(len(self.labels))]
+        for nid, label, shape in zip(ids, self.labels, self.shapes):
+            open_, close = _SHAPES.get(shape, _RECT)
+            yield "".join((nid, open_, '"', label, '"', close))
         for s, d, lbl in self.edges:
             if lbl:
                 # use -->|label| syntax
-                safe_lbl = escape_label(lbl)
-                lines.append(f'{s} -->|{safe_lbl}| {d}')
+                yield "".join((ids[s], _EDGE_LABEL_OPEN, escape_label(lbl), _EDGE_LABEL_CLOSE, ids[d]))
             else:
-                lines.append(f'{s} --> {d}')
+                yield "".join((ids[s], _EDGE, ids[d]))
 
-        mermaid = "\n".join(lines)
-        logger.debug("Generated Mermaid:\n" + mermaid)
-        return mermaid
+    def iter_mermaid_chunks(self, lines_per_chunk: int = _STREAM_CHUNK_LINES):
+        """Same text as build_for_function, in chunks of lines_per_chunk lines.
 
-@app.post("/analyze")
-async def analyze_code(request: CodeRequest, function_name: str = Query(None)):
-    code = request.code
+        Starlette pulls each item of a sync iterator through the threadpool, so yielding
+        single lines would cost one thread round trip per node/edge.
+        """
+        lines = self.iter_mermaid_lines()
+        sep = ""
+        while True:
+            batch = list(islice(lines, lines_per_chunk))
+            if not batch:
+                return
+            yield sep + "\n".join(batch)
+            sep = "\n"
+
+@lru_cache(maxsize=256)
+def _index_functions(code: str):
+    """Parse code and do a single ast.walk: (function names in walk order, {name: first FunctionDef}).
+
+    Cached per distinct source string, since the UI re-posts the same code a lot.
+    """
+    names = []
+    by_name = {}
+    for n in ast.walk(ast.parse(code)):
+        if type(n) is ast.FunctionDef:
+            names.append(n.name)
+            by_name.setdefault(n.name, n)
+    return tuple(names), by_name
+
+@lru_cache(maxsize=512)
+def _mermaid_cached(code: str, func_name: str) -> str:
+    """Mermaid flowchart for func_name in code; caller must check the function exists."""
+    target = _index_functions(code)[1][func_name]
+    return FlowBuilder(code).build_for_function(target)
+
+def _do_analyze(code: str, function_name: str = None) -> dict:
+    """CPU-bound part of /analyze; runs in the threadpool so it doesn't block the event loop."""
     try:
-        tree = ast.parse(code)
+        func_names, by_name = _index_functions(code)
     except Exception as e:
         return {"error": f"Failed to parse code: {e}"}
 
-    functions = [n for n in ast.walk(tree) if isinstance(n, ast.FunctionDef)]
-    func_names = [f.name for f in functions]
-    result = {"functions": {"count": len(func_names), "names": func_names}}
+    result = {"functions": {"count": len(func_names), "names": list(func_names)}}
 
     if function_name:
-        target = None
-        for f in functions:
-            if f.name == function_name:
-                target = f
-                break
-        if not target:
+        if function_name not in by_name:
             return {"error": f"Function '{function_name}' not found", **result}
 
-        builder = FlowBuilder()
-        mermaid = builder.build_for_function(target)
-        # debug print on server console
-        logger.info("MERMAID OUTPUT:\n" + mermaid)
+        mermaid = _mermaid_cached(code, function_name)
+        # debug print on server console (full text, so only at DEBUG)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("MERMAID OUTPUT:\n%s", mermaid)
         result["flowchart"] = mermaid
     else:
         result["flowchart"] = None
 
     return result
 
+@app.post("/analyze")
+async def analyze_code(request: CodeRequest, function_name: str = Query(None)):
+    return await run_in_threadpool(_do_analyze, request.code, function_name)
+
+@app.post("/analyze/flowchart")
+async def analyze_flowchart(request: CodeRequest, function_name: str = Query(...)):
+    """Stream the raw Mermaid text (text/plain) for one function, for very large flowcharts."""
+    code = request.code
+    try:
+        _, by_name = await run_in_threadpool(_index_functions, code)
+    except Exception as e:
+        return {"error": f"Failed to parse code: {e}"}
+    target = by_name.get(function_name)
+    if target is None:
+        return {"error": f"Function '{function_name}' not found"}
+
+    # built fresh rather than from _mermaid_cached: a cached string is the full text in memory
+    builder = FlowBuilder(code)
+    await run_in_threadpool(builder.build_graph, target)
+    return StreamingResponse(builder.iter_mermaid_chunks(), media_type="text/plain")
+
 @app.get("/")
 async def root():
-    return {"message": "CodeMap API running. POST /analyze with JSON {code: '...'} and optional ?function_name=foo"}
+    return {"message": "CodeMap API running. POST /analyze with JSON {code: '...'} and optional ?function_name=foo; POST /analyze/flowchart?function_name=foo streams the Mermaid text"}
+
+if __name__ == "__main__":
+    import uvicorn
+    # production settings: no reload, one worker per core; loop/http "auto"
+    # pick uvloop and httptools (see requirements.txt) when they are installed
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, loop="auto", http="auto",
+                workers=os.cpu_count())